@@ -1,12 +1,12 @@
 import io
 from datetime import date
 import pandas as pd
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import streamlit as st
 from database import (
-    init_db, create_user, authenticate_user, get_user_by_id,
+    connect, set_connection_factory, init_db, create_user, authenticate_user, get_user_by_id,
     add_expense, get_expenses_df, delete_expense, update_expense,
-    set_budget, get_budget, get_month_total, get_top_category
+    set_budget, get_budget, get_month_total, get_category_totals
 )
 
 st.set_page_config(page_title="Multi-user Expense Tracker", page_icon="💳", layout="wide")
@@ -17,11 +17,76 @@ DEFAULT_CATEGORIES = [
     "Groceries", "Education", "Rent", "Utilities", "Other"
 ]
 
+# ISO formats built directly; avoids strftime's locale-aware formatting path.
 def month_str(d: date) -> str:
-    return d.strftime("%Y-%m")
+    return f"{d.year:04d}-{d.month:02d}"
 
 def to_date_str(d: date) -> str:
-    return d.strftime("%Y-%m-%d")
+    return d.isoformat()
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _load_df(uid: int, s: str, e: str, cats: tuple) -> pd.DataFrame:
+    df = get_expenses_df(uid, s, e, list(cats))
+    df["Month"] = df["Date"].dt.to_period("M").astype(str).astype("category")
+    return df
+
+@st.cache_data(ttl=600, show_spinner=False)
+def _cached_budget(uid: int, month: str):
+    return get_budget(uid, month)
+
+@st.cache_data(ttl=600, show_spinner=False)
+def _cached_category_totals(uid: int, s: str, e: str, cats: tuple):
+    return get_category_totals(uid, s, e, list(cats))
+
+def _invalidate_expense_caches():
+    _load_df.clear()
+    _cached_category_totals.clear()
+
+# Charts are rendered once to PNG and cached as bytes: nothing live is shared between sessions,
+# and Figure() is built outside pyplot so no global figure registry grows behind the cache.
+def _fig_png(fig: Figure) -> bytes:
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=200, bbox_inches="tight")  # same dpi st.pyplot uses
+    return buf.getvalue()
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _pie_png(cats_items: tuple) -> bytes:
+    fig = Figure()
+    ax = fig.subplots()
+    pd.Series(dict(cats_items)).plot.pie(autopct='%.1f%%', ax=ax)
+    ax.set_ylabel('')
+    ax.set_title('Share by Category')
+    return _fig_png(fig)
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _daily_png(daily_items: tuple) -> bytes:
+    fig = Figure()
+    ax = fig.subplots()
+    pd.Series(dict(daily_items)).plot(ax=ax, marker='o')
+    ax.set_title("Daily Expenses Trend")
+    ax.set_xlabel("Date")
+    ax.set_ylabel("Amount (₹)")
+    return _fig_png(fig)
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _monthly_png(monthly_items: tuple) -> bytes:
+    fig = Figure()
+    ax = fig.subplots()
+    pd.Series(dict(monthly_items)).plot(kind="bar", ax=ax)
+    ax.set_xlabel("Month (YYYY-MM)")
+    ax.set_ylabel("Amount (₹)")
+    ax.set_title("Monthly Totals")
+    return _fig_png(fig)
+
+# Messages raised by a write, kept in session_state so they survive the full rerun that follows it
+def _flash(area: str, kind: str, msg: str):
+    st.session_state.setdefault("_flash", []).append((area, kind, msg))
+
+def _show_flash(area: str):
+    pending = st.session_state.get("_flash", [])
+    for kind, msg in [(k, m) for a, k, m in pending if a == area]:
+        getattr(st, kind)(msg)
+    st.session_state["_flash"] = [p for p in pending if p[0] != area]
 
 def ensure_login_state():
     if "user_id" not in st.session_state:
@@ -29,7 +94,16 @@ def ensure_login_state():
     if "username" not in st.session_state:
         st.session_state["username"] = None
 
+# One SQLite connection per browser session: reused across its reruns (each runs on a fresh thread),
+# never shared with other sessions, so their reads still run concurrently under WAL.
+def get_conn():
+    conn = st.session_state.get("_db_conn")
+    if conn is None:
+        conn = st.session_state["_db_conn"] = connect()
+    return conn
+
 # Initialize DB
+set_connection_factory(get_conn)
 init_db()
 ensure_login_state()
 
@@ -96,11 +170,12 @@ with st.sidebar:
     budget_month = st.date_input("Budget month", date(today.year, today.month, 1))
     if st.session_state["user_id"]:
         budget_month_key = month_str(budget_month)
-        current_budget = get_budget(st.session_state["user_id"], budget_month_key)
+        current_budget = _cached_budget(st.session_state["user_id"], budget_month_key)
         st.caption(f"Current budget for {budget_month_key}: " + (f"₹{current_budget:,.2f}" if current_budget is not None else "not set"))
         new_budget = st.number_input("Set / Update budget (₹)", min_value=0.0, step=100.0, value=float(current_budget or 0.0))
         if st.button("Save Budget"):
             set_budget(st.session_state["user_id"], budget_month_key, float(new_budget))
+            _cached_budget.clear()
             st.success(f"Budget for {budget_month_key} set to ₹{new_budget:,.2f}")
             st.rerun()
 
@@ -115,16 +190,15 @@ if st.session_state["user_id"] is None:
 # Load data for the logged-in user with filters
 start_str = to_date_str(start)
 end_str = to_date_str(end)
-df = get_expenses_df(st.session_state["user_id"], start_str, end_str, selected_categories)
-if not df.empty:
-    df["Date"] = pd.to_datetime(df["Date"], format="%Y-%m-%d", errors="coerce")
-    df["Month"] = df["Date"].dt.strftime("%Y-%m")
-
-# Tabs
-tab_add, tab_browse, tab_insights, tab_reports, tab_account = st.tabs(["➕ Add", "📋 Browse", "📈 Insights", "📥 Reports", "⚙️ Account"])
+uid = st.session_state["user_id"]
+cat_filter = tuple(sorted(selected_categories))
+df = _load_df(uid, start_str, end_str, cat_filter)
 
-with tab_add:
+# ---- Tab fragments ----
+@st.fragment
+def add_tab(uid: int):
     st.subheader("Add a new expense")
+    _show_flash("add")
     with st.form("add_expense_form", clear_on_submit=True):
         c1, c2, c3 = st.columns([1,1,1])
         with c1:
@@ -143,27 +217,31 @@ with tab_add:
             if amount <= 0:
                 st.error("Amount should be greater than 0.")
             else:
-                new_id = add_expense(st.session_state["user_id"], to_date_str(expense_date), category, float(amount), note)
-                st.success(f"Added expense #{new_id} — {category} ₹{amount:,.2f} on {expense_date}")
+                new_id = add_expense(uid, to_date_str(expense_date), category, float(amount), note)
+                _invalidate_expense_caches()
+                _flash("add", "success", f"Added expense #{new_id} — {category} ₹{amount:,.2f} on {expense_date}")
 
                 # Budget alert
                 mkey = month_str(expense_date)
-                b = get_budget(st.session_state["user_id"], mkey)
+                b = _cached_budget(uid, mkey)
                 if b is not None:
-                    total = get_month_total(st.session_state["user_id"], mkey)
+                    total = get_month_total(uid, mkey)
                     ratio = total / b if b > 0 else 0
                     if ratio >= 1.0:
-                        st.error(f"⚠️ Budget exceeded for {mkey}! Spent ₹{total:,.2f} / ₹{b:,.2f}.")
+                        _flash("add", "error", f"⚠️ Budget exceeded for {mkey}! Spent ₹{total:,.2f} / ₹{b:,.2f}.")
                     elif ratio >= 0.9:
-                        st.warning(f"🔔 Nearing budget for {mkey}: Spent ₹{total:,.2f} / ₹{b:,.2f} ({ratio*100:.1f}%).")
+                        _flash("add", "warning", f"🔔 Nearing budget for {mkey}: Spent ₹{total:,.2f} / ₹{b:,.2f} ({ratio*100:.1f}%).")
                     else:
-                        st.info(f"Budget status for {mkey}: ₹{total:,.2f} / ₹{b:,.2f} ({ratio*100:.1f}%).")
+                        _flash("add", "info", f"Budget status for {mkey}: ₹{total:,.2f} / ₹{b:,.2f} ({ratio*100:.1f}%).")
 
+                # The write changes every tab, so rerun the whole app rather than just this fragment
                 st.rerun()
 
-
-with tab_browse:
+@st.fragment
+def browse_tab(uid: int, start_str: str, end_str: str, cat_filter: tuple):
+    df = _load_df(uid, start_str, end_str, cat_filter)
     st.subheader("Your expenses (filtered)")
+    _show_flash("browse")
     if df.empty:
         st.info("No expenses found for the current filters.")
     else:
@@ -195,17 +273,22 @@ with tab_browse:
                 colu1, colu2 = st.columns(2)
                 with colu1:
                     if st.button("Save changes"):
-                        update_expense(st.session_state["user_id"], int(selected_id), to_date_str(e_date), e_cat, float(e_amount), e_note)
-                        st.success(f"Updated expense #{selected_id}")
+                        update_expense(uid, int(selected_id), to_date_str(e_date), e_cat, float(e_amount), e_note)
+                        _invalidate_expense_caches()
+                        _flash("browse", "success", f"Updated expense #{selected_id}")
                         st.rerun()
 
                 with colu2:
                     if st.button("Delete"):
-                        delete_expense(st.session_state["user_id"], int(selected_id))
-                        st.warning(f"Deleted expense #{selected_id}")
+                        delete_expense(uid, int(selected_id))
+                        _invalidate_expense_caches()
+                        _flash("browse", "warning", f"Deleted expense #{selected_id}")
                         st.rerun()
 
-with tab_insights:
+@st.fragment
+def insights_tab(uid: int, start: date, end: date, cat_filter: tuple):
+    start_str, end_str = to_date_str(start), to_date_str(end)
+    df = _load_df(uid, start_str, end_str, cat_filter)
     st.subheader("Spending insights")
     if df.empty:
         st.info("No data to visualize. Add some expenses!")
@@ -221,43 +304,29 @@ with tab_insights:
         k3.metric("Transactions", f"{txns}")
 
         # Top spending category
-        top = get_top_category(st.session_state["user_id"], start_str, end_str)
+        cat_rows = _cached_category_totals(uid, start_str, end_str, cat_filter)
+        top = cat_rows[0] if cat_rows else None
         if top:
             st.info(f"🏷️ Top spending category in this period: **{top[0]}** — ₹{float(top[1]):,.2f}")
 
         # Charts
         st.markdown("#### Category-wise breakdown")
-        cats = df.groupby("Category")["Amount"].sum().sort_values(ascending=False)
-        fig1, ax1 = plt.subplots()
-        cats.plot.pie(autopct='%.1f%%', ax=ax1)
-        ax1.set_ylabel('')
-        ax1.set_title('Share by Category')
-        st.pyplot(fig1, use_container_width=True)
+        st.image(_pie_png(tuple(cat_rows)), use_container_width=True)
 
         st.markdown("#### Daily trend")
         daily = df.groupby("Date")["Amount"].sum()
-        fig2, ax2 = plt.subplots()
-        daily.plot(ax=ax2, marker='o')
-        ax2.set_title("Daily Expenses Trend")
-        ax2.set_xlabel("Date")
-        ax2.set_ylabel("Amount (₹)")
-        st.pyplot(fig2, use_container_width=True)
+        st.image(_daily_png(tuple(daily.items())), use_container_width=True)
 
         st.markdown("#### Monthly totals")
-        monthly = df.groupby("Month")["Amount"].sum()
-        fig3, ax3 = plt.subplots()
-        monthly.plot(kind="bar", ax=ax3)
-        ax3.set_xlabel("Month (YYYY-MM)")
-        ax3.set_ylabel("Amount (₹)")
-        ax3.set_title("Monthly Totals")
-        st.pyplot(fig3, use_container_width=True)
+        monthly = df.groupby("Month", observed=True)["Amount"].sum()
+        st.image(_monthly_png(tuple(monthly.items())), use_container_width=True)
 
         # Budget status for the last month in the filtered data
         if not df.empty:
             end_month_key = df["Month"].iloc[-1]
-            b = get_budget(st.session_state["user_id"], end_month_key)
+            b = _cached_budget(uid, end_month_key)
             if b is not None:
-                spent_m = float(df[df["Month"] == end_month_key]["Amount"].sum())
+                spent_m = float(monthly.get(end_month_key, 0.0))
                 ratio = spent_m / b if b > 0 else 0
                 if ratio >= 1.0:
                     st.error(f"⚠️ Budget exceeded for {end_month_key}! Spent ₹{spent_m:,.2f} / ₹{b:,.2f}.")
@@ -266,15 +335,28 @@ with tab_insights:
                 else:
                     st.success(f"Budget status for {end_month_key}: ₹{spent_m:,.2f} / ₹{b:,.2f} ({ratio*100:.1f}%).")
 
+# Tabs
+tab_add, tab_browse, tab_insights, tab_reports, tab_account = st.tabs(["➕ Add", "📋 Browse", "📈 Insights", "📥 Reports", "⚙️ Account"])
+# Add / Browse / Insights are fragments: their own widgets rerun only that block, not the whole page.
+# Writes (add / save / delete) still rerun the whole app so every tab and the export see the change.
+with tab_add:
+    add_tab(uid)
+with tab_browse:
+    browse_tab(uid, start_str, end_str, cat_filter)
+with tab_insights:
+    insights_tab(uid, start, end, cat_filter)
+
 with tab_reports:
     st.subheader("Export / Download")
     if df.empty:
         st.info("No data to export for the current filters.")
     else:
-        csv_bytes = df.to_csv(index=False).encode("utf-8")
-        fname = f"{st.session_state['username']}_expenses_{start_str}_to_{end_str}.csv"
-        st.download_button("Download CSV (filtered)", data=csv_bytes, file_name=fname, mime="text/csv")
-        st.caption("CSV includes current filters (date range + categories).")
+        buf = io.BytesIO()
+        df.to_csv(buf, index=False, compression={"method": "gzip", "compresslevel": 6})
+        csv_bytes = buf.getvalue()
+        fname = f"{st.session_state['username']}_expenses_{start_str}_to_{end_str}.csv.gz"
+        st.download_button("Download CSV (filtered, gzip)", data=csv_bytes, file_name=fname, mime="application/gzip")
+        st.caption("Gzip-compressed CSV; includes current filters (date range + categories).")
 
 with tab_account:
     st.subheader("Account")
@@ -1,20 +1,101 @@
 import os
 import sqlite3
+import threading
+from functools import lru_cache
+from datetime import datetime, timezone
+import numpy as np
 import pandas as pd
 import secrets
 import hashlib
-from typing import Optional, List
+import hmac
+from typing import Callable, Iterable, List, Optional, Tuple
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 DB_PATH = os.path.join(DATA_DIR, "expenses.db")
 
-def _connect():
+# ---- SQL ----
+# Kept as constants so every call sends the identical text and hits the connection's statement cache.
+_SQL_USER_ID_BY_NAME = "SELECT id FROM users WHERE username = ?"
+_SQL_INSERT_USER = "INSERT INTO users (username, password_hash, salt, created_at) VALUES (?, ?, ?, ?)"
+_SQL_USER_CREDS = "SELECT id, password_hash, salt FROM users WHERE username = ?"
+_SQL_UPDATE_PASSWORD_HASH = "UPDATE users SET password_hash = ? WHERE id = ?"
+_SQL_USER_BY_ID = "SELECT id, username, created_at FROM users WHERE id = ?"
+_SQL_INSERT_EXPENSE = "INSERT INTO expenses (user_id, date, category, amount, note) VALUES (?, ?, ?, ?, ?)"
+_SQL_DELETE_EXPENSE = "DELETE FROM expenses WHERE user_id = ? AND id = ?"
+_SQL_UPDATE_EXPENSE = "UPDATE expenses SET date=?, category=?, amount=?, note=? WHERE user_id = ? AND id = ?"
+_SQL_UPSERT_BUDGET = ("INSERT INTO budgets (user_id, month, amount) VALUES (?, ?, ?) "
+                      "ON CONFLICT(user_id, month) DO UPDATE SET amount=excluded.amount")
+_SQL_GET_BUDGET = "SELECT amount FROM budgets WHERE user_id = ? AND month = ?"
+_SQL_MONTH_TOTAL = "SELECT total FROM monthly_totals WHERE user_id = ? AND month = ?"
+# Base statements extended with optional filters; each filter combination is still a stable string.
+_SQL_EXPENSES_BASE = "SELECT id, date, category, amount, note FROM expenses WHERE user_id = ?"
+_SQL_CATEGORY_TOTALS_BASE = "SELECT category, SUM(amount) AS total FROM expenses WHERE user_id = ?"
+
+def connect() -> sqlite3.Connection:
     os.makedirs(DATA_DIR, exist_ok=True)
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
+    # WAL lets readers run alongside the single writer; the rest are per-connection tuning.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")      # 64 MiB page cache
+    conn.execute("PRAGMA mmap_size=268435456")    # 256 MiB
+    return conn
+
+# One connection per thread, kept open for the process lifetime so the page cache survives reruns.
+_local = threading.local()
+
+# Optional override for where helpers get their connection. app.py plugs in a per-session handle, since
+# Streamlit runs every rerun on a fresh thread and would otherwise reopen the thread-local one. A factory
+# must not hand one connection to concurrent callers: reads would serialize and see uncommitted writes.
+_conn_factory: Optional[Callable[[], sqlite3.Connection]] = None
+
+def set_connection_factory(factory: Optional[Callable[[], sqlite3.Connection]]) -> None:
+    global _conn_factory
+    _conn_factory = factory
+
+# SQLite has a single writer; serialize writes in-process instead of racing for the file lock.
+# Reads stay unlocked (WAL lets them run alongside a writer).
+_WRITE_LOCK = threading.Lock()
+
+def _get_conn() -> sqlite3.Connection:
+    if _conn_factory is not None:
+        return _conn_factory()
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = connect()
+        _local.conn = conn
+    return conn
+
+# Set once the schema is known to be current, so later Streamlit reruns skip init_db's checks entirely.
+_schema_ready = False
 
 def init_db() -> None:
-    conn = _connect()
-    cur = conn.cursor()
+    global _schema_ready
+    if _schema_ready:
+        return
+    conn = _get_conn()
+    if not _schema_current(conn):
+        # Slow path (new or older database file): one locked transaction, since SQLite DDL is transactional,
+        # so a concurrent session or a failure part-way can't leave monthly_totals unseeded or seeded twice.
+        with _WRITE_LOCK:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                _create_schema(conn.cursor())
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+    _schema_ready = True
+
+def _schema_current(conn: sqlite3.Connection) -> bool:
+    # Cheap, unlocked read: _create_schema builds everything in one transaction, so these two imply the rest.
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    totals = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'monthly_totals'").fetchone()
+    return version >= 1 and totals is not None
+
+def _create_schema(cur: sqlite3.Cursor) -> None:
     # Users table
     cur.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -37,8 +118,15 @@ def init_db() -> None:
             FOREIGN KEY(user_id) REFERENCES users(id)
         )
     """)
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_expenses_user_date ON expenses(user_id, date)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_expenses_user_category ON expenses(user_id, category)")
+    # Covers the browse query (get_expenses_df) so it never has to visit the table rows.
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_expenses_cover ON expenses(user_id, date, id, category, amount, note)")
+    # Schema migrations, run once per database file
+    cur.execute("PRAGMA user_version")
+    if cur.fetchone()[0] < 1:
+        # idx_expenses_cover starts with (user_id, date), so the old index is a redundant prefix
+        cur.execute("DROP INDEX IF EXISTS idx_expenses_user_date")
+        cur.execute("PRAGMA user_version = 1")
 
     # Budgets per user per month
     cur.execute("""
@@ -50,12 +138,58 @@ def init_db() -> None:
             FOREIGN KEY(user_id) REFERENCES users(id)
         )
     """)
-    conn.commit()
-    conn.close()
+
+    # Per user per month spend, kept in sync with expenses by the triggers below
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'monthly_totals'")
+    backfill = cur.fetchone() is None
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS monthly_totals (
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,   -- YYYY-MM
+            total REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY(user_id, month)
+        )
+    """)
+    # Amounts carry 2 decimals, so totals are rounded to 2 places to stop float drift accumulating across
+    # edits; a month that drops to zero is removed (get_month_total reads a missing row as 0.0).
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_expenses_ai AFTER INSERT ON expenses BEGIN
+            INSERT INTO monthly_totals (user_id, month, total) VALUES (NEW.user_id, substr(NEW.date, 1, 7), ROUND(NEW.amount, 2))
+            ON CONFLICT(user_id, month) DO UPDATE SET total = ROUND(total + excluded.total, 2);
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_expenses_ad AFTER DELETE ON expenses BEGIN
+            UPDATE monthly_totals SET total = ROUND(total - OLD.amount, 2)
+            WHERE user_id = OLD.user_id AND month = substr(OLD.date, 1, 7);
+            DELETE FROM monthly_totals WHERE user_id = OLD.user_id AND month = substr(OLD.date, 1, 7) AND total = 0;
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_expenses_au AFTER UPDATE OF user_id, date, amount ON expenses BEGIN
+            UPDATE monthly_totals SET total = ROUND(total - OLD.amount, 2)
+            WHERE user_id = OLD.user_id AND month = substr(OLD.date, 1, 7);
+            DELETE FROM monthly_totals WHERE user_id = OLD.user_id AND month = substr(OLD.date, 1, 7) AND total = 0;
+            INSERT INTO monthly_totals (user_id, month, total) VALUES (NEW.user_id, substr(NEW.date, 1, 7), ROUND(NEW.amount, 2))
+            ON CONFLICT(user_id, month) DO UPDATE SET total = ROUND(total + excluded.total, 2);
+        END
+    """)
+    if backfill:
+        # First run against an existing database: seed from the expenses already there
+        cur.execute("""
+            INSERT INTO monthly_totals (user_id, month, total)
+            SELECT user_id, substr(date, 1, 7), ROUND(SUM(amount), 2) FROM expenses GROUP BY user_id, substr(date, 1, 7)
+        """)
 
 # ---- User helpers ----
+_PBKDF2_ITERATIONS = 120_000
+
 def _hash_password(password: str, salt: str) -> str:
-    # Simple SHA-256 with salt. Good for demo, not recommended for production.
+    # PBKDF2-HMAC-SHA256; OpenSSL runs the iterations (using SHA extensions where the CPU has them).
+    return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), bytes.fromhex(salt), _PBKDF2_ITERATIONS).hex()
+
+def _legacy_hash_password(password: str, salt: str) -> str:
+    # Original single salted SHA-256; only checked so older accounts can log in and be upgraded.
     h = hashlib.sha256()
     h.update((salt + password).encode("utf-8"))
     return h.hexdigest()
@@ -64,134 +198,159 @@ def create_user(username: str, password: str) -> Optional[int]:
     username = username.strip()
     if not username or not password:
         return None
-    conn = _connect()
-    cur = conn.cursor()
-    # Check exists
-    cur.execute("SELECT id FROM users WHERE username = ?", (username,))
-    if cur.fetchone():
-        conn.close()
-        return None
+    # Hash outside the lock; PBKDF2 is the slow part.
     salt = secrets.token_hex(16)
     password_hash = _hash_password(password, salt)
-    created_at = pd.Timestamp.utcnow().isoformat()
-    cur.execute("INSERT INTO users (username, password_hash, salt, created_at) VALUES (?, ?, ?, ?)",
-                (username, password_hash, salt, created_at))
-    conn.commit()
-    user_id = cur.lastrowid
-    conn.close()
+    created_at = datetime.now(timezone.utc).isoformat()
+    conn = _get_conn()
+    with _WRITE_LOCK:
+        cur = conn.cursor()
+        # Check exists
+        cur.execute(_SQL_USER_ID_BY_NAME, (username,))
+        if cur.fetchone():
+            return None
+        cur.execute(_SQL_INSERT_USER, (username, password_hash, salt, created_at))
+        conn.commit()
+        user_id = cur.lastrowid
+    _user_creds.cache_clear()
     return int(user_id)
 
+# Credential lookup only; the password check stays in authenticate_user.
+# Cleared whenever users change (create_user, hash upgrade), since a cached miss would hide a new account.
+@lru_cache(maxsize=1024)
+def _user_creds(username: str) -> Optional[Tuple[int, str, str]]:
+    cur = _get_conn().cursor()
+    cur.execute(_SQL_USER_CREDS, (username,))
+    return cur.fetchone()
+
 def authenticate_user(username: str, password: str) -> Optional[int]:
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("SELECT id, password_hash, salt FROM users WHERE username = ?", (username.strip(),))
-    row = cur.fetchone()
-    conn.close()
+    row = _user_creds(username.strip())
     if not row:
         return None
     user_id, password_hash, salt = row
-    if _hash_password(password, salt) == password_hash:
+    if hmac.compare_digest(_hash_password(password, salt), password_hash):
+        return int(user_id)
+    if hmac.compare_digest(_legacy_hash_password(password, salt), password_hash):
+        # Re-hash with PBKDF2 now that we have the plaintext.
+        new_hash = _hash_password(password, salt)
+        conn = _get_conn()
+        with _WRITE_LOCK:
+            conn.execute(_SQL_UPDATE_PASSWORD_HASH, (new_hash, user_id))
+            conn.commit()
+        _user_creds.cache_clear()
         return int(user_id)
     return None
 
 def get_user_by_id(user_id: int):
-    conn = _connect()
+    conn = _get_conn()
     cur = conn.cursor()
-    cur.execute("SELECT id, username, created_at FROM users WHERE id = ?", (user_id,))
+    cur.execute(_SQL_USER_BY_ID, (user_id,))
     row = cur.fetchone()
-    conn.close()
     return row
 
 # ---- Expenses ----
 def add_expense(user_id: int, date: str, category: str, amount: float, note: str = "") -> int:
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO expenses (user_id, date, category, amount, note) VALUES (?, ?, ?, ?, ?)",
-                (user_id, date, category, amount, note or ""))
-    conn.commit()
-    rowid = cur.lastrowid
-    conn.close()
+    conn = _get_conn()
+    with _WRITE_LOCK:
+        cur = conn.cursor()
+        cur.execute(_SQL_INSERT_EXPENSE, (user_id, date, category, amount, note or ""))
+        conn.commit()
+        rowid = cur.lastrowid
     return int(rowid)
 
-def get_expenses_df(user_id: int,
-                    start_date: Optional[str] = None,
-                    end_date: Optional[str] = None,
-                    categories: Optional[List[str]] = None) -> pd.DataFrame:
-    conn = _connect()
-    query = "SELECT id AS ID, date AS Date, category AS Category, amount AS Amount, note AS Note FROM expenses WHERE user_id = ?"
+# Bulk import: rows are (date, category, amount, note); returns the number inserted.
+def add_expenses_bulk(user_id: int, rows: Iterable[Tuple[str, str, float, str]]) -> int:
+    conn = _get_conn()
+    params = [(user_id, d, c, a, n or "") for d, c, a, n in rows]
+    with _WRITE_LOCK, conn:  # single BEGIN/COMMIT, so one fsync for the whole batch
+        conn.executemany(_SQL_INSERT_EXPENSE, params)
+    return len(params)
+
+# Shared optional filters for the browse and category-total queries, so the table and charts always agree.
+# Returns the " AND ..." suffix plus params, with user_id first to match the "WHERE user_id = ?" bases.
+def _filter_clause(user_id: int,
+                   start_date: Optional[str] = None,
+                   end_date: Optional[str] = None,
+                   categories: Optional[List[str]] = None) -> Tuple[str, list]:
+    where = ""
     params: list = [user_id]
     if start_date:
-        query += " AND date >= ?"
+        where += " AND date >= ?"
         params.append(start_date)
     if end_date:
-        query += " AND date <= ?"
+        where += " AND date <= ?"
         params.append(end_date)
     if categories:
         placeholders = ",".join(["?"] * len(categories))
-        query += f" AND category IN ({placeholders})"
+        where += f" AND category IN ({placeholders})"
         params.extend(categories)
-    query += " ORDER BY date ASC, id ASC"
-    df = pd.read_sql_query(query, conn, params=params)
-    conn.close()
-    return df
+    return where, params
 
-def delete_expense(user_id: int, expense_id: int) -> None:
-    conn = _connect()
+def get_expenses_df(user_id: int,
+                    start_date: Optional[str] = None,
+                    end_date: Optional[str] = None,
+                    categories: Optional[List[str]] = None) -> pd.DataFrame:
+    conn = _get_conn()
+    where, params = _filter_clause(user_id, start_date, end_date, categories)
+    query = _SQL_EXPENSES_BASE + where + " ORDER BY date ASC, id ASC"
     cur = conn.cursor()
-    cur.execute("DELETE FROM expenses WHERE user_id = ? AND id = ?", (user_id, expense_id))
-    conn.commit()
-    conn.close()
+    cur.execute(query, params)
+    data = cur.fetchall()
+    # Columns are built with known dtypes, skipping read_sql_query's per-column type inference.
+    n = len(data)
+    return pd.DataFrame({
+        "ID": np.fromiter((r[0] for r in data), dtype=np.int64, count=n),
+        "Date": pd.to_datetime([r[1] for r in data], format="%Y-%m-%d", errors="coerce"),
+        "Category": pd.Categorical([r[2] for r in data]),
+        "Amount": np.fromiter((r[3] for r in data), dtype=np.float64, count=n),
+        "Note": [r[4] for r in data],
+    })
+
+def delete_expense(user_id: int, expense_id: int) -> None:
+    conn = _get_conn()
+    with _WRITE_LOCK:
+        cur = conn.cursor()
+        cur.execute(_SQL_DELETE_EXPENSE, (user_id, expense_id))
+        conn.commit()
 
 def update_expense(user_id: int, expense_id: int, date: str, category: str, amount: float, note: str) -> None:
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("UPDATE expenses SET date=?, category=?, amount=?, note=? WHERE user_id = ? AND id = ?",
-                (date, category, amount, note, user_id, expense_id))
-    conn.commit()
-    conn.close()
+    conn = _get_conn()
+    with _WRITE_LOCK:
+        cur = conn.cursor()
+        cur.execute(_SQL_UPDATE_EXPENSE, (date, category, amount, note, user_id, expense_id))
+        conn.commit()
 
 # ---- Budgets ----
 def set_budget(user_id: int, month: str, amount: float) -> None:
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO budgets (user_id, month, amount) VALUES (?, ?, ?) "
-                "ON CONFLICT(user_id, month) DO UPDATE SET amount=excluded.amount",
-                (user_id, month, amount))
-    conn.commit()
-    conn.close()
+    conn = _get_conn()
+    with _WRITE_LOCK:
+        cur = conn.cursor()
+        cur.execute(_SQL_UPSERT_BUDGET, (user_id, month, amount))
+        conn.commit()
 
 def get_budget(user_id: int, month: str) -> Optional[float]:
-    conn = _connect()
+    conn = _get_conn()
     cur = conn.cursor()
-    cur.execute("SELECT amount FROM budgets WHERE user_id = ? AND month = ?", (user_id, month))
+    cur.execute(_SQL_GET_BUDGET, (user_id, month))
     row = cur.fetchone()
-    conn.close()
     return float(row[0]) if row else None
 
 def get_month_total(user_id: int, month: str) -> float:
-    start = f"{month}-01"
-    end = f"{month}-31"
-    conn = _connect()
+    conn = _get_conn()
     cur = conn.cursor()
-    cur.execute("SELECT COALESCE(SUM(amount), 0) FROM expenses WHERE user_id = ? AND date >= ? AND date <= ?",
-                (user_id, start, end))
-    total = cur.fetchone()[0] or 0.0
-    conn.close()
+    # Primary-key lookup on the trigger-maintained summary table
+    cur.execute(_SQL_MONTH_TOTAL, (user_id, month))
+    row = cur.fetchone()
+    total = row[0] if row else 0.0
     return float(total)
 
-def get_top_category(user_id: int, start_date: Optional[str] = None, end_date: Optional[str] = None):
-    conn = _connect()
-    query = "SELECT category, COALESCE(SUM(amount),0) as total FROM expenses WHERE user_id = ?"
-    params = [user_id]
-    if start_date:
-        query += " AND date >= ?"
-        params.append(start_date)
-    if end_date:
-        query += " AND date <= ?"
-        params.append(end_date)
-    query += " GROUP BY category ORDER BY total DESC LIMIT 1"
+def get_category_totals(user_id: int,
+                        start_date: Optional[str] = None,
+                        end_date: Optional[str] = None,
+                        categories: Optional[List[str]] = None) -> List[Tuple[str, float]]:
+    conn = _get_conn()
+    where, params = _filter_clause(user_id, start_date, end_date, categories)
+    query = _SQL_CATEGORY_TOTALS_BASE + where + " GROUP BY category ORDER BY total DESC"
     cur = conn.cursor()
     cur.execute(query, params)
-    row = cur.fetchone()
-    conn.close()
-    return row  # (category, total) or None
+    return [(cat, float(total)) for cat, total in cur.fetchall()]  # largest first